@@ -12,74 +12,291 @@ import os
 import sys
 import logging
 import errno
+import threading
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
+from cachetools import TTLCache
 from fuse import FUSE, FuseOSError, Operations
 
+log = logging.getLogger(__name__)
+
+def _stat_to_attr(st):
+    """
+    os.stat_resultをgetattrが返す辞書に変換する
+    """
+    return {'st_atime': st.st_atime, 'st_ctime': st.st_ctime,
+            'st_gid': st.st_gid, 'st_mode': st.st_mode, 'st_mtime': st.st_mtime,
+            'st_nlink': st.st_nlink, 'st_size': st.st_size, 'st_uid': st.st_uid}
+
+class VirtualContentProducer(object):
+    """
+    仮想ファイルの内容をバックグラウンドスレッドでchunk_sizeごとに用意しておくクラス
+    （内容の生成が重い場合でも、生成済みの範囲のreadはブロックせずに返せる）
+    """
+
+    def __init__(self, source, chunk_size):
+        """
+        source: 内容をbytesで順に返すiterable
+        """
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._done = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._produce, args=(source,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, source):
+        size = self.chunk_size
+        try:
+            # チャンクに満たない端数だけを持ち越し、受け取ったデータはビューで切り出す
+            tail = bytearray()
+            for data in source:
+                view = memoryview(data)
+                i = 0
+                if tail:
+                    i = size - len(tail)
+                    tail += view[:i]
+                    if len(tail) < size:
+                        continue
+                    self._append(bytes(tail))
+                    tail = bytearray()
+                n = len(view)
+                if i == 0 and n == size and isinstance(data, bytes):
+                    # ちょうど1チャンク分のbytesはコピーせずそのまま使う
+                    self._append(data)
+                    continue
+                while i + size <= n:
+                    self._append(bytes(view[i:i+size]))
+                    i += size
+                tail += view[i:]
+            if tail:
+                self._append(bytes(tail))
+        except Exception:
+            log.exception('failed to produce virtual content')
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _append(self, chunk):
+        with self._cond:
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+
+    def _wait(self, index):
+        """
+        index番目のチャンクが用意できるまで待つ。内容の末尾を超えていればFalseを返す
+        """
+        if not self._done:
+            with self._cond:
+                while len(self._chunks) <= index and not self._done:
+                    self._cond.wait()
+        return index < len(self._chunks)
+
+    def read(self, offset, size):
+        index, skip = divmod(offset, self.chunk_size)
+        # チャンク境界・サイズどおりの要求は用意済みのチャンクをそのまま返す
+        if skip == 0 and size == self.chunk_size:
+            return self._chunks[index] if self._wait(index) else b''
+        pieces = []
+        while size > 0 and self._wait(index):
+            piece = self._chunks[index][skip:skip+size]
+            if not piece:
+                break
+            pieces.append(piece)
+            size -= len(piece)
+            index += 1
+            skip = 0
+        return b''.join(pieces)
+
 class VirtualFileDiscripter(Operations):
     # 仮想ファイル名
     VIRTUAL_FILE = u'nothing.txt'
-    VIRTUAL_FILE_VALUE = 'ほげほげほげ'*10000+'end\n'
+    # 仮想ファイルの内容（FUSEにはbytesで返すため、クラス定義時にエンコードしておく）
+    VIRTUAL_FILE_VALUE = (u'ほげほげほげ'*10000+u'end\n').encode('utf-8')
+    VIRTUAL_FILE_SIZE = len(VIRTUAL_FILE_VALUE)
+    # 仮想ファイルに割り当てるファイルディスクリプタ（任意の整数）
+    # 実在するfdと番号が重なり得るので、判定は必ずパスと組み合わせて行う
+    _VIRTUAL_FH = 55110
+    # カーネルが一度に要求するread()のサイズ（128KB）
+    READ_CHUNK_SIZE = 131072
+    # 仮想ファイルの属性（内容が不変なので固定値）
+    _VIRTUAL_ATTR = {'st_ctime': 0, 'st_mtime': 0, 'st_nlink': 1, 'st_mode': 33060, 'st_size': VIRTUAL_FILE_SIZE, 'st_gid': 1004, 'st_uid': 1000, 'st_atime': 0}
 
     def __init__(self, root):
         self.root = root
-        logging.debug('virtual file name:%s'  , self.VIRTUAL_FILE)
-        logging.debug('virtual file value:%s' , self.VIRTUAL_FILE_VALUE)
+        # _full_path用に末尾を'/'に揃えたルート
+        self._root = root.rstrip('/') + '/'
+        # READ_CHUNK_SIZE境界で切り出した仮想ファイルの内容
+        self._producer = VirtualContentProducer((self.VIRTUAL_FILE_VALUE,), self.READ_CHUNK_SIZE)
+        # readdirで常に返すエントリ
+        self._dirent_prefix = [u'.', u'..', self.VIRTUAL_FILE]
+        # 仮想ファイルのパス（各コールバックでの比較用に一度だけ組み立てる）
+        self._virtual_path = sys.intern(u'/' + self.VIRTUAL_FILE)
+        # ログレベルはマウント前に確定しているので、ここで一度だけ判定する
+        self._debug = log.isEnabledFor(logging.DEBUG)
+        # getattrの結果キャッシュ（書き込み系の操作で無効化する）
+        self._attr_cache = TTLCache(maxsize=1024, ttl=1.0)
+        # 存在しなかったパスのキャッシュ（作成系の操作で無効化する）
+        self._neg_cache = TTLCache(maxsize=512, ttl=5.0)
+        # マルチスレッドで動かすため、キャッシュの操作はロックで保護する
+        self._attr_lock = threading.Lock()
+        # lstat中に無効化されたパスの古い結果をキャッシュしないための情報
+        # _attr_gen: 無効化のたびに進める世代番号
+        # _lookups: 実行中の検索（開始時の世代ごとの件数）
+        # _invalidated: 検索の実行中に無効化されたパスとその世代
+        # _cleared: キャッシュ全体を破棄した世代
+        self._attr_gen = 0
+        self._lookups = {}
+        self._invalidated = {}
+        self._cleared = 0
+        if self._debug:
+            log.debug('virtual file name:%s'  , self.VIRTUAL_FILE)
+            log.debug('virtual file value:%s' , self.VIRTUAL_FILE_VALUE)
 
     # Helpers
     # =======
 
     def _full_path(self, partial):
-        logging.debug('call _full_path [partial:%s]', partial)
-        if partial.startswith("/"):
-            partial = partial[1:]
-        path = os.path.join(self.root, partial)
-        return path
+        if self._debug:
+            log.debug('call _full_path [partial:%s]', partial)
+        if partial[:1] == '/':
+            return self._root + partial[1:]
+        return self._root + partial
+
+    def _invalidate(self, *paths):
+        with self._attr_lock:
+            self._attr_gen += 1
+            for path in paths:
+                if self._lookups:
+                    self._invalidated[path] = self._attr_gen
+                self._attr_cache.pop(path, None)
+                self._neg_cache.pop(path, None)
+
+    def _begin_lookup(self):
+        """
+        キャッシュを使わない検索を始める（_attr_lockを取得した状態で呼ぶ）
+        """
+        gen = self._attr_gen
+        self._lookups[gen] = self._lookups.get(gen, 0) + 1
+        return gen
+
+    def _finish_lookup(self, gen, results):
+        """
+        検索結果（パス→属性、存在しなければNone）をキャッシュに登録して検索を終える
+        検索の開始後に無効化されたパスの結果は古いかもしれないので登録しない
+        """
+        with self._attr_lock:
+            if self._cleared <= gen:
+                for path, attr in results.items():
+                    if self._invalidated.get(path, gen) > gen:
+                        continue
+                    if attr is None:
+                        self._neg_cache[path] = True
+                    else:
+                        self._attr_cache[path] = attr
+                        self._neg_cache.pop(path, None)
+            count = self._lookups[gen] - 1
+            if count:
+                self._lookups[gen] = count
+            else:
+                del self._lookups[gen]
+            if not self._lookups:
+                self._invalidated.clear()
+            elif len(self._invalidated) > self._attr_cache.maxsize:
+                # 実行中のどの検索よりも前の無効化は不要
+                oldest = min(self._lookups)
+                self._invalidated = dict((path, g) for path, g in self._invalidated.items() if g > oldest)
 
     # Filesystem methods
     # ==================
 
     def access(self, path, mode):
-        logging.debug('call access [path:%s, mode:%s]', path, mode)
+        if self._debug:
+            log.debug('call access [path:%s, mode:%s]', path, mode)
         full_path = self._full_path(path)
         if not os.access(full_path, mode):
             raise FuseOSError(errno.EACCES)
 
     def chmod(self, path, mode):
-        logging.debug('call chmod [path:%s]', path)
+        if self._debug:
+            log.debug('call chmod [path:%s]', path)
         full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        os.chmod(full_path, mode)
+        self._invalidate(path)
 
     def chown(self, path, uid, gid):
-        logging.debug('call chown [path:%s]', path)
+        if self._debug:
+            log.debug('call chown [path:%s]', path)
         full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        os.chown(full_path, uid, gid)
+        self._invalidate(path)
 
-    def getattr(self, path, fh=None):
-        if path == u'/' + self.VIRTUAL_FILE:
-            attr={'st_ctime': 0, 'st_mtime': 0, 'st_nlink': 1, 'st_mode': 33060, 'st_size': len(self.VIRTUAL_FILE_VALUE), 'st_gid': 1004, 'st_uid': 1000, 'st_atime': 0}
+    # 呼び出し回数の多いメソッドでは、os関数をデフォルト引数でローカル変数に束縛しておく
+    def getattr(self, path, fh=None, _lstat=os.lstat):
+        if path == self._virtual_path:
+            attr = self._VIRTUAL_ATTR
         else:
-            full_path = self._full_path(path)
-            st = os.lstat(full_path)
-            attr = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                    'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-        logging.debug('call getattr [path:%s, attr:%s]', path, attr)
+            with self._attr_lock:
+                attr = self._attr_cache.get(path)
+                missing = attr is None and path in self._neg_cache
+                if attr is None and not missing:
+                    gen = self._begin_lookup()
+            if missing:
+                raise FuseOSError(errno.ENOENT)
+            if attr is None:
+                full_path = self._full_path(path)
+                try:
+                    st = _lstat(full_path)
+                except FileNotFoundError:
+                    self._finish_lookup(gen, {path: None})
+                    raise
+                except BaseException:
+                    self._finish_lookup(gen, {})
+                    raise
+                attr = _stat_to_attr(st)
+                self._finish_lookup(gen, {path: attr})
+        if self._debug:
+            log.debug('call getattr [path:%s, attr:%s]', path, attr)
         return attr
     
     def readdir(self, path, fh):
         """
         ディレクトリリスティング用のメソッド
         """
-        logging.debug('call readdir [path:%s]', path)
-        dirents = [u'.', u'..', self.VIRTUAL_FILE]
-        
+        if self._debug:
+            log.debug('call readdir [path:%s]', path)
+        dirents = self._dirent_prefix[:]
         full_path = self._full_path(path)
         if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
-        for r in dirents:
-            yield r
+            # 続けて呼ばれるgetattr（ls -lなど）がキャッシュに当たるよう属性も登録しておく
+            # （キャッシュに収まらない大きなディレクトリでは、他のエントリを追い出すだけなので行わない）
+            prefix = path.rstrip('/') + '/'
+            attrs = {}
+            with self._attr_lock:
+                gen = self._begin_lookup()
+            try:
+                with os.scandir(full_path) as it:
+                    entries = list(it)
+                dirents.extend(entry.name for entry in entries)
+                if len(entries) <= self._attr_cache.maxsize:
+                    for entry in entries:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            # 列挙中に削除されたエントリはキャッシュしない
+                            continue
+                        attrs[prefix + entry.name] = _stat_to_attr(st)
+            finally:
+                # 列挙できたパスは存在するので、否定キャッシュからも外される
+                self._finish_lookup(gen, attrs)
+        return dirents
 
     def readlink(self, path):
-        logging.debug('call readlink [path:%s]', path)
+        if self._debug:
+            log.debug('call readlink [path:%s]', path)
         pathname = os.readlink(self._full_path(path))
         if pathname.startswith("/"):
             # Path name is absolute, sanitize it.
@@ -88,45 +305,68 @@ class VirtualFileDiscripter(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        logging.debug('call mknod [path:%s]', path)
-        return os.mknod(self._full_path(path), mode, dev)
+        if self._debug:
+            log.debug('call mknod [path:%s]', path)
+        os.mknod(self._full_path(path), mode, dev)
+        self._invalidate(path, os.path.dirname(path))
 
     def rmdir(self, path):
-        logging.debug('call rmdir [path:%s]', path)
+        if self._debug:
+            log.debug('call rmdir [path:%s]', path)
         full_path = self._full_path(path)
-        return os.rmdir(full_path)
+        os.rmdir(full_path)
+        self._invalidate(path, os.path.dirname(path))
 
     def mkdir(self, path, mode):
-        logging.debug('call mkdir [path:%s]', path)
-        return os.mkdir(self._full_path(path), mode)
+        if self._debug:
+            log.debug('call mkdir [path:%s]', path)
+        os.mkdir(self._full_path(path), mode)
+        self._invalidate(path, os.path.dirname(path))
 
     def statfs(self, path):
-        logging.debug('call statfs [path:%s]', path)
+        if self._debug:
+            log.debug('call statfs [path:%s]', path)
         full_path = self._full_path(path)
         stv = os.statvfs(full_path)
-        return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
-            'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag',
-            'f_frsize', 'f_namemax'))
+        return {'f_bavail': stv.f_bavail, 'f_bfree': stv.f_bfree,
+            'f_blocks': stv.f_blocks, 'f_bsize': stv.f_bsize, 'f_favail': stv.f_favail,
+            'f_ffree': stv.f_ffree, 'f_files': stv.f_files, 'f_flag': stv.f_flag,
+            'f_frsize': stv.f_frsize, 'f_namemax': stv.f_namemax}
 
     def unlink(self, path):
-        logging.debug('call ulink [path:%s]', path)
-        return os.unlink(self._full_path(path))
+        if self._debug:
+            log.debug('call unlink [path:%s]', path)
+        os.unlink(self._full_path(path))
+        self._invalidate(path, os.path.dirname(path))
 
     def symlink(self, name, target):
-        logging.debug('call symlink [path:%s]', path)
-        return os.symlink(name, self._full_path(target))
+        if self._debug:
+            log.debug('call symlink [name:%s, target:%s]', name, target)
+        os.symlink(name, self._full_path(target))
+        self._invalidate(target, os.path.dirname(target))
 
     def rename(self, old, new):
-        logging.debug('call rename [path:%s]', path)
-        return os.rename(self._full_path(old), self._full_path(new))
+        if self._debug:
+            log.debug('call rename [old:%s, new:%s]', old, new)
+        os.rename(self._full_path(old), self._full_path(new))
+        # ディレクトリの場合は配下のパスもすべて変わるのでキャッシュを破棄する
+        with self._attr_lock:
+            self._attr_gen += 1
+            self._cleared = self._attr_gen
+            self._attr_cache.clear()
+            self._neg_cache.clear()
 
     def link(self, target, name):
-        logging.debug('call link [path:%s]', path)
-        return os.link(self._full_path(target), self._full_path(name))
+        if self._debug:
+            log.debug('call link [target:%s, name:%s]', target, name)
+        os.link(self._full_path(target), self._full_path(name))
+        self._invalidate(target, name, os.path.dirname(name))
 
     def utimens(self, path, times=None):
-        logging.debug('call utimens [path:%s]', path)
-        return os.utime(self._full_path(path), times)
+        if self._debug:
+            log.debug('call utimens [path:%s]', path)
+        os.utime(self._full_path(path), times)
+        self._invalidate(path)
 
     # File methods
     # ============
@@ -135,67 +375,129 @@ class VirtualFileDiscripter(Operations):
         """
         ファイルオープン
         """
-        if path == u'/' + self.VIRTUAL_FILE:
+        if path == self._virtual_path:
             # ファイルディスクリプタを返す（任意の整数を返すことにする）
-            fd = 55110
+            fd = self._VIRTUAL_FH
         else:
             full_path = self._full_path(path)
             fd = os.open(full_path, flags)
-        logging.debug('call open [path:%s, flags:%s, fd:%d]', path, flags, fd)
+        if self._debug:
+            log.debug('call open [path:%s, flags:%s, fd:%d]', path, flags, fd)
         return fd
 
     def create(self, path, mode, fi=None):
-        logging.debug('call create [path:%s]', path)
+        if self._debug:
+            log.debug('call create [path:%s]', path)
         full_path = self._full_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        fd = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        self._invalidate(path, os.path.dirname(path))
+        return fd
 
-    def read(self, path, size, offset, fh):
+    def read(self, path, size, offset, fh, _pread=os.pread):
         """
         ファイルを読み込むメソッド
         """
-        logging.debug('call read [path:%s, size:%d, offset:%d, fh:%d]', path, size, offset, fh)
-        if path == u'/' + self.VIRTUAL_FILE:
-            return self.VIRTUAL_FILE_VALUE[offset:offset+size]
+        if self._debug:
+            log.debug('call read [path:%s, size:%d, offset:%d, fh:%d]', path, size, offset, fh)
+        if path == self._virtual_path and fh == self._VIRTUAL_FH:
+            return self._producer.read(offset, size)
         else:
-            os.lseek(fh, offset, os.SEEK_SET)
-            return os.read(fh, size)
-
-    def write(self, path, buf, offset, fh):
-        logging.debug('call write [path:%s]', path)
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+            # 同じfhへの並行読み込みでファイルオフセットを共有しないようpreadを使う
+            return _pread(fh, size, offset)
+
+    def write(self, path, buf, offset, fh, _pwrite=os.pwrite):
+        if self._debug:
+            log.debug('call write [path:%s]', path)
+        if path == self._virtual_path and fh == self._VIRTUAL_FH:
+            # 仮想ファイルは読み込み専用
+            raise FuseOSError(errno.EACCES)
+        written = _pwrite(fh, buf, offset)
+        self._invalidate(path)
+        return written
 
     def truncate(self, path, length, fh=None):
-        logging.debug('call truncate [path:%s]', path)
-        full_path = self._full_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        if self._debug:
+            log.debug('call truncate [path:%s]', path)
+        if path == self._virtual_path:
+            raise FuseOSError(errno.EACCES)
+        if fh is None:
+            os.truncate(self._full_path(path), length)
+        else:
+            os.ftruncate(fh, length)
+        self._invalidate(path)
 
     def flush(self, path, fh):
-        logging.debug('call flush [path:%s]', path)
-        if path == u'/' + self.VIRTUAL_FILE:
-            return None
-        else:
-            return os.fsync(fh)
+        if self._debug:
+            log.debug('call flush [path:%s]', path)
+        # flushはclose毎に呼ばれるだけなので何もしない（永続化はfsyncで行う）
+        return None
 
     def release(self, path, fh):
-        logging.debug('release call [path:%s]', path)
-        if path == u'/' + self.VIRTUAL_FILE:
+        if self._debug:
+            log.debug('release call [path:%s]', path)
+        if path == self._virtual_path and fh == self._VIRTUAL_FH:
             return None
         else:
             return os.close(fh)
 
     def fsync(self, path, fdatasync, fh):
-        logging.debug('fsync call', path)
-        return self.flush(path, fh)
+        if self._debug:
+            log.debug('fsync call [path:%s]', path)
+        if path == self._virtual_path and fh == self._VIRTUAL_FH:
+            return None
+        elif fdatasync:
+            return os.fdatasync(fh)
+        else:
+            return os.fsync(fh)
 
 
 def main(mountpoint, root):
-    logging.info('runining main')
-    FUSE(VirtualFileDiscripter(root), mountpoint, nothreads=True, foreground=True)
+    log.info('runining main')
+    # カーネル側で属性・エントリ・ページをキャッシュさせ、コールバック自体を減らす
+    FUSE(VirtualFileDiscripter(root), mountpoint, nothreads=False, foreground=True,
+            auto_cache=True, entry_timeout=60.0, attr_timeout=60.0, negative_timeout=5.0,
+            big_writes=True, max_read=VirtualFileDiscripter.READ_CHUNK_SIZE,
+            max_readahead=VirtualFileDiscripter.READ_CHUNK_SIZE,
+            max_write=VirtualFileDiscripter.READ_CHUNK_SIZE)
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    メッセージの整形をQueueListener側のスレッドに任せるQueueHandler
+    """
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """
+    環境変数FUSE_LOG_LEVELでログレベルを設定する（既定はWARNING）
+    DEBUGの場合はFUSEのスレッドで整形・出力しないよう、QueueListenerを返す
+    """
+    name = os.environ.get('FUSE_LOG_LEVEL', '').strip() or 'WARNING'
+    if name.isdigit():
+        level = int(name)
+    else:
+        # 既知のレベル名ならint、それ以外は'Level xxx'という文字列が返る
+        level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        sys.exit('invalid FUSE_LOG_LEVEL: %r (use DEBUG, INFO, WARNING, ERROR, CRITICAL or a number)' % name)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
+    if level > logging.DEBUG:
+        logging.basicConfig(level=level, handlers=[handler])
+        return None
+    q = queue.Queue(-1)
+    logging.basicConfig(level=level, handlers=[_DeferredQueueHandler(q)])
+    listener = QueueListener(q, handler)
+    listener.start()
+    return listener
 
 if __name__ == '__main__':
     # log config
-    logging.basicConfig(format='%(asctime)s: %(message)s',level=logging.DEBUG)
-    main(sys.argv[2], sys.argv[1])
+    listener = setup_logging()
+    try:
+        main(sys.argv[2], sys.argv[1])
+    finally:
+        if listener is not None:
+            listener.stop()
 